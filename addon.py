@@ -1,4 +1,6 @@
 import os
+import json
+import base64
 import logging
 import threading
 import time
@@ -6,9 +8,25 @@ import requests
 import re
 import subprocess
 import shutil
-from flask import Flask, jsonify, request, send_from_directory, Response, make_response
+import sqlite3
+import functools
+import importlib.util
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, jsonify, request, send_file, Response, make_response, abort
 from flask_cors import CORS
 
+import ffsubsync_worker
+
+try:
+    import fastsync  # precisa do numpy, que vem junto com o ffsubsync
+except ImportError:
+    fastsync = None
+
 # --- Configurações ---
 
 app = Flask(__name__)
@@ -18,13 +36,158 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("AutoSyncAddon")
 
 CACHE_DIR = os.path.join(os.getcwd(), "subtitle_cache")
-TEMP_DIR = os.path.join(os.getcwd(), "temp_processing")
+
+def default_temp_dir():
+    """Temporários em tmpfs (/dev/shm) quando disponível: as SRTs baixadas não tocam o disco."""
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm/autosync_tmp"
+    return os.path.join(os.getcwd(), "temp_processing")
+
+TEMP_DIR = os.getenv("TEMP_DIR") or default_temp_dir()
 os.makedirs(CACHE_DIR, exist_ok=True)
 os.makedirs(TEMP_DIR, exist_ok=True)
 
 OS_API_KEY = os.getenv("OS_API_KEY", "")
 USER_AGENT = os.getenv("USER_AGENT", "StremioAutoSync v1.0")
 
+# Atrás de nginx/Apache: o proxy serve o .srt via sendfile(2) em vez do Python
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_PREFIX", "").rstrip('/')  # ex: /internal_subs (nginx)
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "0") == "1"  # Apache mod_xsendfile
+
+# Embute .srt pequenos como data: URL na resposta, poupando um round trip ao /static_subs
+INLINE_SUBS = os.getenv("INLINE_SUBS", "0") == "1"
+INLINE_MAX_BYTES = 64 * 1024
+
+# Syncs simultâneos e requisições paralelas (links/downloads) dentro de cada sync
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", max(2, (os.cpu_count() or 2) // 2)))
+FANOUT_WORKERS = 4
+
+# Sessão única: reaproveita conexões keep-alive (TCP+TLS) com a API e com o CDN de download.
+# gzip/deflate já vão no Accept-Encoding padrão do requests.
+SESSION = requests.Session()
+SESSION.headers.update({"Api-Key": OS_API_KEY, "User-Agent": USER_AGENT, "Content-Type": "application/json"})
+_POOL_MAXSIZE = max(20, SYNC_WORKERS * FANOUT_WORKERS)  # sem "Connection pool is full" sob carga
+_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=_POOL_MAXSIZE,
+    max_retries=Retry(
+        total=3, connect=2, read=2, backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "HEAD"]),
+    ),
+)
+# POST /download conta na cota: se a resposta se perdeu depois do envio (read/5xx), o download
+# pode já ter sido cobrado. Só repete quando o pedido nem chegou (connect) ou veio 429.
+_download_adapter = HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=_POOL_MAXSIZE,
+    max_retries=Retry(
+        total=2, connect=2, read=0, backoff_factor=0.3,
+        status_forcelist=[429],
+        allowed_methods=frozenset(["POST"]),
+    ),
+)
+# (connect, read): nenhum upstream lento prende uma thread do pool indefinidamente
+HTTP_TIMEOUT = (3, 15)
+SESSION.mount("https://", _adapter)
+SESSION.mount("https://api.opensubtitles.com/api/v1/download", _download_adapter)
+
+# Hosts aquecidos no startup (DNS + TCP + TLS) para o 1º poll do Stremio não pagar o handshake
+WARMUP_URLS = [
+    "https://api.opensubtitles.com/api/v1/infos/formats",
+    "https://www.opensubtitles.com/",
+    "https://dl.opensubtitles.org/",
+]
+
+# Pool limitado de sincronizações + chaves em andamento (evita rodar o mesmo ffsubsync 2x)
+EXECUTOR = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix="sync")
+_INFLIGHT = set()
+_INFLIGHT_LOCK = threading.Lock()
+
+# Índice em memória {cache_key: [arquivos .srt prontos]}, evita varrer o CACHE_DIR
+CACHE_INDEX = defaultdict(list)
+CACHE_INDEX_LOCK = threading.Lock()
+# Job concluído = '<cache_key>.done' no CACHE_DIR (lista as versões publicadas). É o que vale entre
+# os workers do gunicorn: o índice de cada processo pode ter só a v1 enquanto outro gera v2/v3.
+# Caches antigos sem marcador e sem escrita há DONE_MIGRATION_AGE ganham um no startup.
+DONE_MIGRATION_AGE = 3600
+# Single-flight entre workers: '<cache_key>.lock' criado com O_EXCL; lock mais velho que isso é de worker morto
+JOB_LOCK_TTL = 1800
+
+# Eventos {filename: Event} para acordar o serve_subs assim que o .srt é publicado
+_READY_EVENTS = {}
+_READY_LOCK = threading.Lock()
+SERVE_TIMEOUT = 20  # segundos; agora busca 3 legendas
+
+# Limite de disco do CACHE_DIR; os .srt menos acessados são apagados primeiro (LRU)
+MAX_CACHE_BYTES = int(os.getenv("MAX_CACHE_BYTES", 500 * 1024 * 1024))
+EVICTION_INTERVAL = 600
+LAST_ACCESS = {}  # {filename: epoch do último acesso servido por este processo}
+
+# Cache do JSON de busca /subtitles por (imdb, idioma, temporada, episódio) e cache negativo
+# (títulos sem PT-BR, poupa a cota da API). SQLite em WAL: compartilhado entre os workers do
+# gunicorn e sobrevive a crash/restart
+SEARCH_CACHE_DB = os.path.join(CACHE_DIR, "_searchcache.db")
+TTL_SEARCH = 3600
+NEG_CACHE_TTL = 6 * 3600
+_SEARCH_DB_LOCAL = threading.local()
+
+# id do Stremio: 'tt1234567' (filme) ou 'tt1234567:1:2' (série)
+_ID_RE = re.compile(r'(tt(\d+))(?::(\d+):(\d+))?')
+# Únicos nomes servidos em /static_subs (barra path traversal sem o safe_join do send_from_directory)
+_SUB_FILE_RE = re.compile(r'tt\d+(?:_S\d+E\d+)?_v\d+\.srt')
+
+# Marcadores de release para classificar as referências EN: uma única passada,
+# o grupo nomeado diz a classe. Precedência entre classes: WEB > BLURAY > HDTV
+CLASS_RE = re.compile(
+    r'(?P<WEB>web|amzn|nf|hulu|netflix|disney)'
+    r'|(?P<BLURAY>bluray|bdrip|brrip|blue|bdr)'
+    r'|(?P<HDTV>hdtv|tv|pdtv|dsr)'
+)
+CLASS_PRIORITY = ('WEB', 'BLURAY', 'HDTV')
+
+# Se o 1º sync quase não mexeu na legenda, as versões cuja referência EN tem o mesmo timing
+# da 1ª (fastsync entre as referências) viram cópia dela; as demais rodam o sync normalmente
+SKIP_ALIGNED_VARIANTS = os.getenv("SKIP_ALIGNED_VARIANTS", "1") == "1"
+ALIGNED_MAX_OFFSET = 0.1  # segundos
+_FFS_OFFSET_RE = re.compile(r'offset seconds:\s*(-?[\d.]+)')
+_FFS_SCALE_RE = re.compile(r'scale factor:\s*([\d.]+)')
+# Só para o fallback em subprocesso (CLI): os workers do FFS_POOL limitam o BLAS em ffsubsync_worker.init
+_FFSUBSYNC_ENV = {**os.environ, "OMP_NUM_THREADS": "1", "OPENBLAS_NUM_THREADS": "1", "MKL_NUM_THREADS": "1"}
+
+# Workers persistentes do ffsubsync: cada processo importa o ffsubsync uma vez (ffsubsync_worker.init)
+# e atende vários syncs, sem pagar o startup do CLI por versão. forkserver: os workers não herdam
+# as threads/sockets do Flask e só pré-carregam o módulo do worker, não o addon.
+# Um crash do ffsubsync derruba só o worker (BrokenProcessPool), não o Flask: o pool é recriado.
+FFS_WORKERS = int(os.getenv("FFS_WORKERS", min(4, os.cpu_count() or 2)))
+# Back-pressure: no máximo 2 syncs por worker entre rodando e na fila; os demais esperam na thread
+_FFS_SLOTS = threading.BoundedSemaphore(2 * FFS_WORKERS)
+# Teto por sync, contado dentro do worker a partir do início da execução (SIGALRM em ffsubsync_worker.sync)
+FFS_TIMEOUT = int(os.getenv("FFS_TIMEOUT", 300))
+# Último recurso do lado do addon (fila + execução): só estoura se o alarme não interromper o worker
+# (travado em código C). Com no máximo 2 syncs por worker, a fila espera no máximo uma rodada.
+FFS_HARD_TIMEOUT = 3 * FFS_TIMEOUT
+_FFS_POOL_LOCK = threading.Lock()
+
+def new_ffs_pool():
+    return ProcessPoolExecutor(max_workers=FFS_WORKERS, mp_context=_FFS_CONTEXT,
+                               initializer=ffsubsync_worker.init)
+
+if importlib.util.find_spec("ffsubsync") is not None:
+    # forkserver não existe em todo SO (ex: Windows): lá fica o spawn
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        _FFS_CONTEXT = multiprocessing.get_context("forkserver")
+        _FFS_CONTEXT.set_forkserver_preload(["ffsubsync_worker"])
+    else:
+        _FFS_CONTEXT = multiprocessing.get_context("spawn")
+    FFS_POOL = new_ffs_pool()
+else:
+    FFS_POOL = None
+
+# Atalho sem ffsubsync: se PT-BR e referência só diferem por um offset constante,
+# aplica o deslocamento direto nos tempos (milissegundos em vez de segundos de VAD). Ver fastsync.py
+FAST_SYNC = os.getenv("FAST_SYNC", "1") == "1"
+
 MANIFEST = {
     "id": "community.autosync.ptbr",
     "version": "0.0.6",
@@ -37,12 +200,202 @@ MANIFEST = {
 
 # --- Utilitários ---
 
+@functools.lru_cache(maxsize=4096)
+def parse_id(id_str):
+    """'tt123:1:2' -> ('tt123', 123, 1, 2); None se não for um id IMDb."""
+    m = _ID_RE.fullmatch(id_str)
+    if not m: return None
+    imdb_id, imdb_num, season, episode = m.groups()
+    return (imdb_id, int(imdb_num), int(season) if season else None, int(episode) if episode else None)
+
+@functools.lru_cache(maxsize=4096)
 def get_file_hash(imdb_id, season=None, episode=None):
     base = f"{imdb_id}"
     if season and episode:
         base += f"_S{season}E{episode}"
     return base
 
+@functools.lru_cache(maxsize=8192)
+def cache_path(filename):
+    return os.path.join(CACHE_DIR, filename)
+
+def index_add(cache_key, filename):
+    with CACHE_INDEX_LOCK:
+        if filename not in CACHE_INDEX[cache_key]:
+            CACHE_INDEX[cache_key].append(filename)
+
+def ready_event(filename):
+    with _READY_LOCK:
+        return _READY_EVENTS.setdefault(filename, threading.Event())
+
+def notify_ready(filename):
+    with _READY_LOCK:
+        ev = _READY_EVENTS.pop(filename, None)
+    if ev: ev.set()
+
+def drop_event(filename):
+    """Descarta o Event de quem parou de esperar: notify_ready pode nunca vir para este nome."""
+    with _READY_LOCK:
+        _READY_EVENTS.pop(filename, None)
+
+def mark_ready(cache_key, filename):
+    """Registra um .srt publicado no índice e acorda quem está esperando por ele."""
+    index_add(cache_key, filename)
+    notify_ready(filename)
+
+def index_remove(cache_key, filename):
+    with CACHE_INDEX_LOCK:
+        files = CACHE_INDEX.get(cache_key)
+        if files and filename in files:
+            files.remove(filename)
+            if not files:
+                del CACHE_INDEX[cache_key]
+
+def is_ready(cache_key, filename, file_path):
+    """Consulta o índice em memória (sem syscall); o stat só cobre o que outro worker publicou."""
+    if filename in CACHE_INDEX.get(cache_key, ()): return True
+    if is_published(file_path):
+        index_add(cache_key, filename)
+        return True
+    return False
+
+def done_path(cache_key):
+    return cache_path(f"{cache_key}.done")
+
+def mark_done(cache_key):
+    """Grava o marcador de job concluído com as versões que existem no disco."""
+    versions = [v for v in ("v1", "v2", "v3") if is_published(cache_path(f"{cache_key}_{v}.srt"))]
+    if not versions: return
+    final_path = done_path(cache_key)
+    tmp_path = f"{final_path}.{os.getpid()}.part"
+    with open(tmp_path, 'w') as f:
+        f.write(" ".join(versions))
+    publish(tmp_path, final_path)
+
+def read_done(cache_key):
+    """Versões publicadas de um job concluído; None se ainda não terminou (em nenhum worker)."""
+    try:
+        with open(done_path(cache_key)) as f:
+            return f.read().split() or None
+    except OSError:
+        return None
+
+def drop_done(cache_key):
+    try:
+        os.remove(done_path(cache_key))
+    except OSError:
+        pass
+
+def claim_job(cache_key):
+    """Reserva o sync da chave para este processo; False se outro worker já está nela."""
+    path = cache_path(f"{cache_key}.lock")
+    for _ in range(2):
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(path).st_mtime < JOB_LOCK_TTL: return False
+                os.remove(path)
+            except OSError:
+                pass
+    return False
+
+def release_job(cache_key):
+    try:
+        os.remove(cache_path(f"{cache_key}.lock"))
+    except OSError:
+        pass
+
+def touch_cache(filename):
+    LAST_ACCESS[filename] = time.time()
+
+def build_cache_index():
+    """Varre o CACHE_DIR uma única vez no startup: '<cache_key>_vN.srt'."""
+    newest = {}
+    for filename in os.listdir(CACHE_DIR):
+        if filename.startswith("_") or not filename.endswith(".srt"): continue
+        if filename.endswith(".part.srt"): continue
+        cache_key = filename.rsplit("_", 1)[0]
+        index_add(cache_key, filename)
+        try:
+            newest[cache_key] = max(newest.get(cache_key, 0), os.stat(cache_path(filename)).st_mtime)
+        except OSError:
+            pass
+    cutoff = time.time() - DONE_MIGRATION_AGE
+    for cache_key, mtime in newest.items():
+        if mtime < cutoff and not os.path.exists(done_path(cache_key)):
+            mark_done(cache_key)
+
+def evict_cache():
+    """Apaga os .srt menos acessados até o CACHE_DIR caber em MAX_CACHE_BYTES."""
+    entries = []
+    total = 0
+    for filename in os.listdir(CACHE_DIR):
+        if filename.startswith("_") or not filename.endswith(".srt"): continue
+        if filename.endswith(".part.srt"): continue
+        try:
+            st = os.stat(cache_path(filename))
+        except OSError:
+            continue
+        total += st.st_size
+        # Sem acesso registrado aqui (restart, outro worker): usa o atime do disco
+        entries.append((LAST_ACCESS.get(filename, st.st_atime), filename, st.st_size))
+
+    if total <= MAX_CACHE_BYTES: return
+    entries.sort()
+    for _, filename, size in entries:
+        if total <= MAX_CACHE_BYTES: break
+        cache_key = filename.rsplit("_", 1)[0]
+        if cache_key in _INFLIGHT: continue
+        drop_done(cache_key)  # antes do .srt: ninguém anuncia uma versão que sumiu
+        try:
+            os.remove(cache_path(filename))
+        except OSError:
+            continue
+        index_remove(cache_key, filename)
+        LAST_ACCESS.pop(filename, None)
+        total -= size
+    logger.info(f"Cache LRU: CACHE_DIR reduzido para {total} bytes")
+
+def eviction_loop():
+    while True:
+        time.sleep(EVICTION_INTERVAL)
+        try:
+            evict_cache()
+        except Exception as e:
+            logger.error(f"Erro na limpeza do cache: {e}")
+        # Buscas/negativos vencidos também saem em runtime, não só no startup
+        purge_search_cache()
+
+def is_negligible_correction(offset, scale):
+    return abs(offset) < ALIGNED_MAX_OFFSET and 0.99 < scale < 1.01
+
+def is_already_aligned(ffsubsync_log):
+    """Lê o offset/escala que o ffsubsync reportou e diz se a correção foi desprezível."""
+    m_offset = _FFS_OFFSET_RE.search(ffsubsync_log)
+    m_scale = _FFS_SCALE_RE.search(ffsubsync_log)
+    if not m_offset or not m_scale: return False
+    try:
+        return is_negligible_correction(float(m_offset.group(1)), float(m_scale.group(1)))
+    except ValueError:
+        return False
+
+def part_path(final_path):
+    """Caminho temporário ao lado do destino; mantém a extensão .srt para o ffsubsync."""
+    return final_path[:-4] + ".part.srt" if final_path.endswith(".srt") else final_path + ".part"
+
+def publish(tmp_path, final_path):
+    """Rename atômico: quem olha o final_path nunca vê um arquivo pela metade."""
+    os.replace(tmp_path, final_path)
+
+def is_published(path):
+    """Um único stat: o arquivo existe e não está vazio."""
+    try:
+        return os.stat(path).st_size > 0
+    except OSError:
+        return False
+
 def cleanup_temp(files):
     for f in files:
         if f and os.path.exists(f):
@@ -65,33 +418,92 @@ def generate_loading_srt(variant_name):
 
 # --- OpenSubtitles ---
 
-def get_download_link(file_id, headers):
+def search_db():
+    """Uma conexão SQLite por thread (sqlite3 não compartilha conexões entre threads)."""
+    conn = getattr(_SEARCH_DB_LOCAL, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(SEARCH_CACHE_DB, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS search (key TEXT PRIMARY KEY, data TEXT, ts REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS negative (key TEXT PRIMARY KEY, expires REAL)")
+        _SEARCH_DB_LOCAL.conn = conn
+    return conn
+
+def purge_search_cache():
+    try:
+        with search_db() as conn:
+            conn.execute("DELETE FROM search WHERE ts < ?", (time.time() - TTL_SEARCH,))
+            conn.execute("DELETE FROM negative WHERE expires < ?", (time.time(),))
+    except sqlite3.Error as e:
+        logger.error(f"Erro limpando cache de busca: {e}")
+
+def mark_negative(cache_key):
+    try:
+        with search_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO negative (key, expires) VALUES (?, ?)",
+                         (cache_key, time.time() + NEG_CACHE_TTL))
+    except sqlite3.Error as e:
+        logger.error(f"Erro salvando cache negativo: {e}")
+
+def is_negative(cache_key):
+    try:
+        row = search_db().execute("SELECT expires FROM negative WHERE key = ?", (cache_key,)).fetchone()
+    except sqlite3.Error as e:
+        logger.error(f"Erro lendo cache negativo: {e}")
+        return False
+    return row is not None and row[0] > time.time()
+
+def search_subtitles_raw(imdb_int, lang, season=None, episode=None):
+    """GET /subtitles com cache de TTL_SEARCH segundos. Retorna o JSON da API."""
+    key = f"{imdb_int}|{lang}|{season}|{episode}"
+    try:
+        row = search_db().execute("SELECT data, ts FROM search WHERE key = ?", (key,)).fetchone()
+        if row and time.time() - row[1] < TTL_SEARCH:
+            return json.loads(row[0])
+    except sqlite3.Error as e:
+        logger.error(f"Erro lendo cache de busca: {e}")
+
+    params = {"imdb_id": imdb_int, "languages": lang, "order_by": "download_count", "order_direction": "desc"}
+    if season: params.update({"season_number": season, "episode_number": episode})
+
+    res = SESSION.get("https://api.opensubtitles.com/api/v1/subtitles", params=params, timeout=HTTP_TIMEOUT)
+    res.raise_for_status()
+    data = res.json()
+    try:
+        with search_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO search (key, data, ts) VALUES (?, ?, ?)",
+                         (key, json.dumps(data), time.time()))
+    except sqlite3.Error as e:
+        logger.error(f"Erro salvando cache de busca: {e}")
+    return data
+
+def get_download_link(file_id):
     try:
-        res = requests.post("https://api.opensubtitles.com/api/v1/download", 
-                            headers=headers, json={"file_id": file_id})
+        res = SESSION.post("https://api.opensubtitles.com/api/v1/download", json={"file_id": file_id}, timeout=HTTP_TIMEOUT)
         return res.json().get('link')
     except:
         return None
 
-def search_references_opensubtitles(imdb_id, season=None, episode=None):
+def resolve_download_links(file_ids):
+    """Resolve {chave: file_id} em {chave: link} com os POSTs /download em paralelo."""
+    if not file_ids: return {}
+    keys = list(file_ids)
+    with ThreadPoolExecutor(max_workers=min(FANOUT_WORKERS, len(keys))) as pool:
+        links = pool.map(get_download_link, [file_ids[k] for k in keys])
+    return {k: link for k, link in zip(keys, links) if link}
+
+def search_references_opensubtitles(imdb_int, season=None, episode=None):
     """
     Busca 3 referências distintas: WEB, HDTV e BLURAY.
+    Retorna {tipo: file_id}; os links são resolvidos depois em lote.
     """
     if not OS_API_KEY: return {}
-    
-    headers = {"Api-Key": OS_API_KEY, "Content-Type": "application/json", "User-Agent": USER_AGENT}
-    try: clean_id = int(imdb_id.replace("tt", ""))
-    except: return {}
-
-    params = {"imdb_id": clean_id, "languages": "en", "order_by": "download_count", "order_direction": "desc"}
-    if season: params.update({"season_number": season, "episode_number": episode})
 
-    references = {} # Usar dict para garantir unicidade de tipo: {'WEB': url, 'HDTV': url, 'BLURAY': url}
+    references = {} # Usar dict para garantir unicidade de tipo: {'WEB': file_id, 'HDTV': file_id, 'BLURAY': file_id}
     
     try:
         # Busca mais resultados para ter chance de achar BluRay
-        res = requests.get("https://api.opensubtitles.com/api/v1/subtitles", headers=headers, params=params, timeout=12)
-        data = res.json()
+        data = search_subtitles_raw(imdb_int, "en", season, episode)
         
         if data.get('total_count', 0) > 0:
             results = data['data']
@@ -100,82 +512,151 @@ def search_references_opensubtitles(imdb_id, season=None, episode=None):
                 # Se já preenchemos os 3 slots, para.
                 if len(references) >= 3: break
                 
-                f = item['attributes']['files'][0]
+                files = item['attributes'].get('files')
+                if not files: continue
+                f = files[0]
                 fname = f['file_name'].lower()
                 file_id = f['file_id']
                 
                 # Classificação por Nome
-                rtype = None
-                if any(x in fname for x in ['web', 'amzn', 'nf', 'hulu', 'netflix', 'disney']):
-                    rtype = 'WEB'
-                elif any(x in fname for x in ['bluray', 'bdrip', 'brrip', 'blue', 'bdr']):
-                    rtype = 'BLURAY'
-                elif any(x in fname for x in ['hdtv', 'tv', 'pdtv', 'dsr']):
-                    rtype = 'HDTV'
+                found = {m.lastgroup for m in CLASS_RE.finditer(fname)}
+                rtype = next((c for c in CLASS_PRIORITY if c in found), None)
                 
                 # Se achou um tipo e ainda não temos esse tipo salvo
                 if rtype and rtype not in references:
-                    link = get_download_link(file_id, headers)
-                    if link: references[rtype] = link
+                    references[rtype] = file_id
             
             # Fallback: Se faltou algum slot, preenche com o top download genérico (se não for repetido)
-            if not references and len(results) > 0:
-                 link = get_download_link(results[0]['attributes']['files'][0]['file_id'], headers)
-                 if link: references['DEFAULT'] = link
+            if not references:
+                for item in results:
+                    files = item['attributes'].get('files')
+                    if files:
+                        references['DEFAULT'] = files[0]['file_id']
+                        break
 
     except Exception as e:
         logger.error(f"Erro busca EN: {e}")
     
     return references
 
-def search_best_ptbr(imdb_id, season=None, episode=None):
-    if not OS_API_KEY: return None
-    headers = {"Api-Key": OS_API_KEY, "Content-Type": "application/json", "User-Agent": USER_AGENT}
-    try:
-        params = {"imdb_id": int(imdb_id.replace("tt", "")), "languages": "pt-br", "order_by": "download_count", "order_direction": "desc"}
-        if season: params.update({"season_number": season, "episode_number": episode})
-        
-        res = requests.get("https://api.opensubtitles.com/api/v1/subtitles", headers=headers, params=params)
-        data = res.json()
-        if data.get('total_count', 0) > 0:
-            return get_download_link(data['data'][0]['attributes']['files'][0]['file_id'], headers)
-    except:
-        pass
+def search_best_ptbr(imdb_int, season=None, episode=None):
+    """file_id da PT-BR mais baixada; None só se a busca deu certo e não achou nada (erros sobem)."""
+    if not OS_API_KEY: raise RuntimeError("OS_API_KEY não configurada")
+    data = search_subtitles_raw(imdb_int, "pt-br", season, episode)
+    for item in data.get('data', []):
+        files = item['attributes'].get('files')
+        if files:
+            return files[0]['file_id']
     return None
 
 def download_file(url, dest_path):
+    tmp_path = part_path(dest_path)
     try:
-        with requests.get(url, stream=True) as r:
+        with SESSION.get(url, stream=True, timeout=HTTP_TIMEOUT) as r:
             r.raise_for_status()
-            with open(dest_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            r.raw.decode_content = True
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(r.raw, f, length=1024*1024)
+        publish(tmp_path, dest_path)
         return True
     except:
+        cleanup_temp([tmp_path])
         return False
 
-# --- Core Logic ---
-
-def run_sync_thread(imdb_id, season, episode, cache_key):
-    v1_marker = os.path.join(CACHE_DIR, f"{cache_key}_v1.srt")
-    if os.path.exists(v1_marker): return
+def download_many(jobs):
+    """Baixa {chave: (url, destino)} em paralelo e retorna o conjunto de chaves que deram certo."""
+    if not jobs: return set()
+    keys = list(jobs)
+    with ThreadPoolExecutor(max_workers=min(FANOUT_WORKERS, len(keys))) as pool:
+        results = pool.map(lambda k: download_file(*jobs[k]), keys)
+    return {k for k, ok in zip(keys, results) if ok}
 
-    logger.info(f"Processando TRIPLE SYNC para {cache_key}...")
-    
-    # 1. Baixar PT-BR (Target)
-    url_pt = search_best_ptbr(imdb_id, season, episode)
-    if not url_pt: return 
-    path_pt = os.path.join(TEMP_DIR, f"{cache_key}_pt.srt")
-    if not download_file(url_pt, path_pt): return
-
-    # 2. Baixar Referencias EN
-    refs_dict = search_references_opensubtitles(imdb_id, season, episode)
-    files_clean = [path_pt]
+# --- Core Logic ---
 
-    # Se não achou NADA, copia o original para V1 para não quebrar
-    if not refs_dict:
-        shutil.copy(path_pt, v1_marker)
-        return
+def fast_sync(path_ref, path_pt, out_path):
+    """Tenta o fastsync. Retorna (ok, aligned) ou None para seguir para o ffsubsync."""
+    if not FAST_SYNC or fastsync is None: return None
+    try:
+        shift = fastsync.fast_offset_sync(path_ref, path_pt, out_path)
+    except Exception as e:
+        logger.error(f"Erro no alinhamento rápido: {e}")
+        return None
+    if shift is None: return None
+    logger.info(f"Alinhamento rápido: offset {shift} ms")
+    return True, abs(shift) < ALIGNED_MAX_OFFSET * 1000
+
+def reset_ffs_pool(pool, reason):
+    """Troca o FFS_POOL por um novo e mata os processos do antigo (um worker travado não sai sozinho)."""
+    global FFS_POOL
+    with _FFS_POOL_LOCK:
+        if FFS_POOL is not pool: return  # outra thread já trocou
+        logger.warning(f"{reason}, recriando o pool do ffsubsync")
+        FFS_POOL = new_ffs_pool()
+    for proc in list((pool._processes or {}).values()):
+        proc.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def submit_ffsubsync(path_ref, path_pt, out_path):
+    """
+    Roda um sync no FFS_POOL respeitando o limite de fila.
+    Um sync lento é interrompido dentro do próprio worker (SyncTimeout) sem afetar os outros;
+    o pool só é recriado se um worker morreu ou nem o alarme o destravou.
+    """
+    with _FFS_SLOTS:
+        pool = FFS_POOL
+        try:
+            return pool.submit(ffsubsync_worker.sync, path_ref, path_pt, out_path,
+                               FFS_TIMEOUT).result(timeout=FFS_HARD_TIMEOUT)
+        except BrokenProcessPool:
+            reset_ffs_pool(pool, "Worker do ffsubsync morreu")
+            raise
+        except FuturesTimeout:
+            reset_ffs_pool(pool, f"ffsubsync não respondeu em {FFS_HARD_TIMEOUT}s")
+            raise
+
+# Falhas que não dizem nada sobre a legenda: o job não grava .done e o próximo poll tenta de novo
+TRANSIENT_SYNC_ERRORS = (BrokenProcessPool, FuturesTimeout, ffsubsync_worker.SyncTimeout)
+
+def run_ffsubsync(path_ref, path_pt, out_path):
+    """
+    Sincroniza path_pt usando path_ref como referência.
+    Retorna (ok, aligned): aligned indica que a correção aplicada foi desprezível.
+    """
+    fast = fast_sync(path_ref, path_pt, out_path)
+    if fast is not None: return fast
+    if FFS_POOL is not None:
+        try:
+            retval, offset, scale = submit_ffsubsync(path_ref, path_pt, out_path)
+        except TRANSIENT_SYNC_ERRORS:
+            raise
+        except Exception as e:
+            logger.error(f"Erro no worker do ffsubsync: {e}")
+            return False, False
+        if retval != 0:
+            logger.error(f"ffsubsync retornou {retval}")
+            return False, False
+        return True, offset is not None and scale is not None and is_negligible_correction(offset, scale)
+
+    # Fallback: CLI em subprocesso
+    ffs_args = [path_ref, "-i", path_pt, "-o", out_path, "--encoding", "utf-8"]
+    # stdout não é usado: vai para o DEVNULL; o log (offset/escala) sai no stderr
+    try:
+        result = subprocess.run(["ffsubsync"] + ffs_args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                text=True, env=_FFSUBSYNC_ENV)
+    except Exception as e:
+        logger.error(f"Erro ao rodar ffsubsync: {e}")
+        return False, False
+    if result.returncode != 0:
+        logger.error(f"ffsubsync saiu com código {result.returncode}: {result.stderr[-500:]}")
+        return False, False
+    return True, is_already_aligned(result.stderr)
+
+def fetch_references(refs_ids, cache_key):
+    """
+    Resolve e baixa as referências EN já buscadas (links e downloads em paralelo).
+    Retorna ([(tipo, caminho)] na ordem dos slots, {tipos baixados}).
+    """
+    refs_dict = resolve_download_links(refs_ids)
 
     # Mapeamento fixo para garantir ordem no Stremio: v1=WEB, v2=HDTV, v3=BLURAY
     # Se não tiver algum, usamos o que tiver disponível
@@ -184,30 +665,206 @@ def run_sync_thread(imdb_id, season, episode, cache_key):
     priority_order = ['WEB', 'HDTV', 'BLURAY', 'DEFAULT']
     
     # Cria uma lista ordenada das URLs que encontramos
-    final_refs = []
+    jobs = {}
     for p in priority_order:
         if p in refs_dict:
-            final_refs.append((p, refs_dict[p]))
+            jobs[p] = (refs_dict[p], os.path.join(TEMP_DIR, f"{cache_key}_ref_{p}.srt"))
+    downloaded = download_many(jobs)
+    return [(rtype, path) for rtype, (_, path) in jobs.items()], downloaded
+
+def references_agree(path_a, path_b):
+    """As duas referências EN têm o mesmo timing? Sem fastsync, não dá para afirmar."""
+    if fastsync is None: return False
+    try:
+        shift = fastsync.estimate_offset(fastsync.load_start_times(path_a), fastsync.load_start_times(path_b))
+    except Exception as e:
+        logger.error(f"Erro comparando referências: {e}")
+        return False
+    return shift is not None and abs(shift) < ALIGNED_MAX_OFFSET * 1000
+
+def sync_variant(cache_key, version_label, rtype, path_ref, path_pt):
+    """Roda o ffsubsync de uma versão e publica o .srt. Retorna (ok, aligned)."""
+    final_path = cache_path(f"{cache_key}_{version_label}.srt")
+    tmp_path = part_path(final_path)
+    logger.info(f"Syncing {version_label} ({rtype})...")
+    try:
+        ok, aligned = run_ffsubsync(path_ref, path_pt, tmp_path)
+    except TRANSIENT_SYNC_ERRORS:
+        cleanup_temp([tmp_path])
+        raise
+    if ok:
+        publish(tmp_path, final_path)
+        mark_ready(cache_key, f"{cache_key}_{version_label}.srt")
+    else:
+        cleanup_temp([tmp_path])
+    return ok, aligned
+
+def copy_variant(cache_key, version_label, source_path):
+    final_path = cache_path(f"{cache_key}_{version_label}.srt")
+    shutil.copyfile(source_path, part_path(final_path))
+    publish(part_path(final_path), final_path)
+    mark_ready(cache_key, f"{cache_key}_{version_label}.srt")
+
+def run_sync_thread(imdb_int, season, episode, cache_key):
+    v1_marker = cache_path(f"{cache_key}_v1.srt")
+    if os.path.exists(done_path(cache_key)): return  # concluído aqui ou em outro worker
+
+    logger.info(f"Processando TRIPLE SYNC para {cache_key}...")
     
-    # Processa cada referência encontrada
-    for i, (rtype, url) in enumerate(final_refs):
-        version_label = f"v{i+1}" # v1, v2, v3...
-        final_path = os.path.join(CACHE_DIR, f"{cache_key}_{version_label}.srt")
-        path_ref = os.path.join(TEMP_DIR, f"{cache_key}_ref_{rtype}.srt")
-        files_clean.append(path_ref)
-
-        if download_file(url, path_ref):
-            # Truque: --max-offset-seconds ajuda se o drift for bizarro (comum em extended cuts)
-            cmd = ["ffsubsync", path_ref, "-i", path_pt, "-o", final_path, "--encoding", "utf-8"]
-            logger.info(f"Syncing {version_label} ({rtype})...")
-            try:
-                subprocess.run(cmd, capture_output=True, check=True)
-            except Exception as e:
-                logger.error(f"Erro ao rodar ffsubsync: {e}")
+    # 1. Buscas PT-BR (Target) e EN em paralelo. Cada POST /download conta na cota diária:
+    # os links EN só são pedidos depois que a PT-BR existe e o link dela saiu.
+    path_pt = os.path.join(TEMP_DIR, f"{cache_key}_pt.srt")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        refs_future = pool.submit(search_references_opensubtitles, imdb_int, season, episode)
+        try:
+            pt_file_id = search_best_ptbr(imdb_int, season, episode)
+        except Exception as e:
+            # Timeout/DNS/429 não provam que falta PT-BR: não entra no cache negativo
+            logger.error(f"Erro busca PT-BR: {e}")
+            return
+        if not pt_file_id:
+            mark_negative(cache_key)
+            return
+        url_pt = get_download_link(pt_file_id)
+        if not url_pt: return
+
+        # 2. Download da PT-BR em paralelo com links + downloads das referências
+        pt_future = pool.submit(download_file, url_pt, path_pt)
+        final_refs, downloaded = fetch_references(refs_future.result(), cache_key)
+        pt_ok = pt_future.result()
+    files_clean = [path_pt] + [path for _, path in final_refs]
+
+    if not pt_ok:
+        cleanup_temp(files_clean)
+        return
+
+    # Se não achou NADA, copia o original para V1 para não quebrar
+    if not final_refs:
+        shutil.copy(path_pt, part_path(v1_marker))
+        publish(part_path(v1_marker), v1_marker)
+        mark_ready(cache_key, f"{cache_key}_v1.srt")
+        mark_done(cache_key)
+        cleanup_temp(files_clean)
+        return
     
+    # Processa cada referência encontrada: (v1, WEB, caminho), (v2, HDTV, caminho)...
+    variants = [(f"v{i+1}", rtype, path_ref) for i, (rtype, path_ref) in enumerate(final_refs)]
+
+    # A 1ª versão roda sozinha: se ela quase não mexer na legenda, as referências com o
+    # mesmo timing dela viram cópia (outro corte/framerate continua precisando de sync próprio)
+    lead = next((v for v in variants if v[1] in downloaded), None)
+    try:
+        if lead:
+            ok, aligned = sync_variant(cache_key, *lead, path_pt)
+            pending = [v for v in variants if v is not lead and v[1] in downloaded]
+            if ok and aligned and SKIP_ALIGNED_VARIANTS:
+                lead_path = cache_path(f"{cache_key}_{lead[0]}.srt")
+                same_timing = [v for v in pending if references_agree(lead[2], v[2])]
+                for version_label, rtype, _ in same_timing:
+                    logger.info(f"{version_label} ({rtype}): mesmo timing da {lead[0]}, reaproveitando resultado")
+                    copy_variant(cache_key, version_label, lead_path)
+                pending = [v for v in pending if v not in same_timing]
+            # Demais versões em paralelo, cada uma num worker do FFS_POOL
+            if pending:
+                with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+                    list(pool.map(lambda v: sync_variant(cache_key, *v, path_pt), pending))
+    except TRANSIENT_SYNC_ERRORS as e:
+        # Sem .done: as versões que faltam não ficam omitidas de vez, o próximo poll refaz o job
+        logger.warning(f"Sync de {cache_key} interrompido ({type(e).__name__}), fica para o próximo poll")
+        cleanup_temp(files_clean)
+        return
+
+    mark_done(cache_key)
     cleanup_temp(files_clean)
     logger.info(f"Concluido {cache_key}")
 
+def _run_sync_job(imdb_int, season, episode, cache_key):
+    claimed = claim_job(cache_key)
+    try:
+        if claimed:
+            run_sync_thread(imdb_int, season, episode, cache_key)
+    finally:
+        if claimed:
+            release_job(cache_key)
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.discard(cache_key)
+        # Slots que não foram gerados (ex: sem BluRay): libera quem ainda espera por eles.
+        # Sem o lock o sync é de outro worker: quem espera passa a olhar o disco (serve_subs)
+        if claimed:
+            for version_label in ("v1", "v2", "v3"):
+                notify_ready(f"{cache_key}_{version_label}.srt")
+
+def schedule_sync(imdb_int, season, episode, cache_key):
+    """Enfileira a sincronização no pool, ignorando se a mesma chave já está rodando."""
+    with _INFLIGHT_LOCK:
+        if cache_key in _INFLIGHT:
+            return False
+        _INFLIGHT.add(cache_key)
+    EXECUTOR.submit(_run_sync_job, imdb_int, season, episode, cache_key)
+    return True
+
+def inline_subtitle_url(filename):
+    """data: URL para um .srt pronto e pequeno; None se não couber ou não existir."""
+    file_path = cache_path(filename)
+    try:
+        if os.path.getsize(file_path) >= INLINE_MAX_BYTES: return None
+        with open(file_path, 'rb') as f:
+            touch_cache(filename)
+            return "data:application/x-subrip;base64," + base64.b64encode(f.read()).decode('ascii')
+    except OSError:
+        return None
+
+def build_subtitle(host, cache_key, version_label, inline=False):
+    filename = f"{cache_key}_{version_label}.srt"
+    url = inline_subtitle_url(filename) if inline else None
+    return {
+        "id": f"as_{version_label}_{cache_key}",
+        "url": url or f"{host}/static_subs/{filename}",
+        "lang": "pob",
+        "format": "srt"
+    }
+
+@functools.lru_cache(maxsize=4096)
+def pending_slots(host, cache_key):
+    """Payload das 3 slots enquanto sincroniza; igual para todos os polls da mesma chave."""
+    return {"subtitles": [build_subtitle(host, cache_key, v) for v in ("v1", "v2", "v3")]}
+
+def warm_connections():
+    for url in WARMUP_URLS:
+        try:
+            SESSION.head(url, timeout=5)
+        except Exception:
+            pass
+
+# Com `python addon.py`, os workers do FFS_POOL reimportam este script como __mp_main__: lá não sobe nada
+if __name__ != "__mp_main__":
+    build_cache_index()
+    purge_search_cache()
+    threading.Thread(target=warm_connections, daemon=True).start()
+    threading.Thread(target=eviction_loop, daemon=True).start()
+
+def send_cached_sub(filename):
+    """Resposta para um .srt pronto: delega ao proxy (X-Accel-Redirect) quando configurado."""
+    touch_cache(filename)
+    if X_ACCEL_PREFIX:
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX}/{filename}"
+        response.headers['Content-Type'] = 'application/x-subrip'
+        response.headers['Cache-Control'] = 'public, max-age=31536000'
+        return response
+    # send_file usa wsgi.file_wrapper (sendfile no gunicorn) ou X-Sendfile;
+    # conditional=True responde 304 sem corpo quando o Stremio revalida
+    file_path = cache_path(filename)
+    st = os.stat(file_path)
+    return send_file(
+        file_path,
+        mimetype='application/x-subrip',
+        conditional=True,
+        etag=f"{filename}-{st.st_mtime_ns:x}-{st.st_size:x}",
+        last_modified=st.st_mtime,
+        max_age=31536000,
+    )
+
 # --- Rotas ---
 
 @app.route('/')
@@ -220,58 +877,75 @@ def manifest():
 
 @app.route('/subtitles/<type>/<id>/<extra>.json')
 def subtitles(type, id, extra):
-    parts = id.split(":")
-    imdb_id = parts[0]
-    season = int(parts[1]) if len(parts) > 1 else None
-    episode = int(parts[2]) if len(parts) > 2 else None
+    parsed = parse_id(id)
+    if not parsed:
+        return jsonify({"subtitles": []})
+    imdb_id, imdb_int, season, episode = parsed
     
     cache_key = get_file_hash(imdb_id, season, episode)
-    
-    threading.Thread(target=run_sync_thread, args=(imdb_id, season, episode, cache_key)).start()
+
+    # Já sabemos que não há PT-BR para este título: não gasta cota à toa
+    if is_negative(cache_key):
+        return jsonify({"subtitles": []})
 
     host = request.host_url.rstrip('/')
+
+    # Sync já concluído (marcador .done de qualquer worker): retorna só as versões que existem
+    versions = read_done(cache_key)
+    if versions:
+        etag = f"{cache_key}-{'-'.join(versions)}"
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            response = jsonify({"subtitles": [build_subtitle(host, cache_key, v, inline=INLINE_SUBS) for v in versions]})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'public, max-age=3600, immutable'
+        return response
+    
+    schedule_sync(imdb_int, season, episode, cache_key)
     
     # Retorna 3 Opções fixas. Se o servidor não achar uma delas (ex: não achou BluRay),
     # a rota de download vai ficar no 'Loading' eternamente até dar timeout.
-    # Idealmente, só retornariamos o que existe, mas para 'Resposta Instantanea', 
-    # retornamos as slots e deixamos o usuario testar.
-    return jsonify({
-        "subtitles": [
-            {
-                "id": f"as_v1_{cache_key}",
-                "url": f"{host}/static_subs/{cache_key}_v1.srt",
-                "lang": "pob",
-                "format": "srt"
-            },
-            {
-                "id": f"as_v2_{cache_key}",
-                "url": f"{host}/static_subs/{cache_key}_v2.srt",
-                "lang": "pob",
-                "format": "srt"
-            },
-            {
-                "id": f"as_v3_{cache_key}",
-                "url": f"{host}/static_subs/{cache_key}_v3.srt",
-                "lang": "pob",
-                "format": "srt"
-            }
-        ]
-    })
+    # Para 'Resposta Instantanea' enquanto sincroniza, retornamos as slots e deixamos o usuario testar.
+    # Cache curto + Retry-After: o cliente volta depois em vez de martelar a rota.
+    response = jsonify(pending_slots(host, cache_key))
+    response.headers['Cache-Control'] = 'public, max-age=15'
+    response.headers['Retry-After'] = '15'
+    return response
 
 @app.route('/static_subs/<filename>')
 def serve_subs(filename):
-    file_path = os.path.join(CACHE_DIR, filename)
+    if not _SUB_FILE_RE.fullmatch(filename):
+        abort(404)
+    file_path = cache_path(filename)
+    cache_key = filename.rsplit("_", 1)[0]
     
     # Identifica qual versão é para a mensagem de erro
     variant = "WEB-DL" if "_v1" in filename else "HDTV" if "_v2" in filename else "BluRay"
 
-    max_retries = 20 # Aumentei para 20s pois agora busca 3 legendas
-    for _ in range(max_retries):
-        if os.path.exists(file_path):
-            response = make_response(send_from_directory(CACHE_DIR, filename))
-            response.headers['Cache-Control'] = 'public, max-age=31536000'
-            return response
-        time.sleep(1)
+    version_label = filename[len(cache_key) + 1:-4]
+    deadline = time.monotonic() + SERVE_TIMEOUT
+    try:
+        while True:
+            if is_ready(cache_key, filename, file_path):
+                try:
+                    return send_cached_sub(filename)
+                except FileNotFoundError:
+                    index_remove(cache_key, filename)  # removido pela limpeza de outro worker
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            if cache_key in _INFLIGHT:
+                # Sync neste processo: acorda na hora da publicação
+                if ready_event(filename).wait(min(1, remaining)) and not is_ready(cache_key, filename, file_path):
+                    break  # o sync terminou sem gerar esta versão
+            else:
+                # Sync em outro worker (ou nenhum): só o disco responde, em fatias de 1s
+                versions = read_done(cache_key)
+                if versions and version_label not in versions:
+                    break  # job concluído sem esta versão
+                time.sleep(min(1, remaining))
+    finally:
+        drop_event(filename)
     
     logger.info(f"Timeout servindo {filename}")
     response = make_response(generate_loading_srt(variant))
@@ -281,5 +955,6 @@ def serve_subs(filename):
     return response
 
 if __name__ == '__main__':
+    # Apenas para desenvolvimento local; em produção use o gunicorn (ver wsgi.py)
     port = int(os.environ.get("PORT", 7000))
     app.run(host='0.0.0.0', port=port)
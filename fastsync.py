@@ -0,0 +1,121 @@
+"""
+Alinhamento rápido por offset constante, sem ffsubsync (ver fast_sync em addon.py).
+Só numpy: sem Flask nem rede, testável isolado.
+
+O offset é o pico de um histograma de todas as diferenças ref - PT dentro de
+±MAX_OFFSET_MS (correlação cruzada dos inícios das falas). Casar cada fala com
+a mais próxima sozinho gera alias quando o offset real passa de meio intervalo
+entre falas; o histograma enxerga todos os offsets candidatos e desiste quando
+o pico não se destaca do 2º melhor.
+"""
+import re
+
+import numpy as np
+
+MAX_OFFSET_MS = 10000
+BIN_MS = 50
+MATCH_MS = 150         # tolerância para uma fala PT-BR contar como casada depois do shift
+MIN_MATCHED = 0.6      # fração mínima das falas PT-BR casadas com a referência
+MIN_MARGIN = 1.5       # pico / 2º melhor offset (fora de ±SEPARATION_MS); abaixo disso é ambíguo
+SEPARATION_MS = 500
+MIN_CUES = 20
+
+TIMING_RE = re.compile(r'(\d+):(\d\d):(\d\d)[,.](\d{3})(\s*-->\s*)(\d+):(\d\d):(\d\d)[,.](\d{3})')
+_WEIGHTS = np.array([3600000, 60000, 1000, 1], dtype=np.int64)
+
+
+def srt_timings(text):
+    """Linhas de tempo da SRT -> (matches, array int64 (n, 2) com início/fim em ms)."""
+    matches = list(TIMING_RE.finditer(text))
+    if not matches:
+        return matches, np.empty((0, 2), dtype=np.int64)
+    parts = np.array([m.group(1, 2, 3, 4, 6, 7, 8, 9) for m in matches]).astype(np.int64)
+    return matches, np.stack([parts[:, :4] @ _WEIGHTS, parts[:, 4:] @ _WEIGHTS], axis=1)
+
+
+def format_srt_time(ms):
+    h, ms = divmod(int(ms), 3600000)
+    m, ms = divmod(ms, 60000)
+    s, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+
+
+def nearest_residuals(ref_sorted, starts):
+    """Distância (com sinal) de cada início até o início mais próximo na referência."""
+    idx = np.clip(np.searchsorted(ref_sorted, starts), 1, len(ref_sorted) - 1)
+    left, right = ref_sorted[idx - 1], ref_sorted[idx]
+    return np.where(starts - left <= right - starts, left, right) - starts
+
+
+def estimate_offset(ref_starts, pt_starts):
+    """Offset em ms a somar nos tempos da PT-BR; None se não for um offset constante inequívoco."""
+    ref = np.sort(np.asarray(ref_starts, dtype=np.int64))
+    pt = np.asarray(pt_starts, dtype=np.int64)
+    if len(ref) < MIN_CUES or len(pt) < MIN_CUES: return None
+
+    # Todos os pares (fala PT, fala ref) a até MAX_OFFSET_MS de distância
+    lo = np.searchsorted(ref, pt - MAX_OFFSET_MS, 'left')
+    hi = np.searchsorted(ref, pt + MAX_OFFSET_MS, 'right')
+    counts = hi - lo
+    total = int(counts.sum())
+    if total == 0: return None
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    diffs = ref[np.repeat(lo, counts) + np.arange(total) - first] - np.repeat(pt, counts)
+
+    # Votos por offset numa janela de ±MATCH_MS
+    hist = np.bincount((diffs + MAX_OFFSET_MS) // BIN_MS, minlength=2 * MAX_OFFSET_MS // BIN_MS + 1)
+    votes = np.convolve(hist, np.ones(2 * (MATCH_MS // BIN_MS) + 1, dtype=np.int64), 'same')
+    best = int(np.argmax(votes))
+    masked = votes.copy()
+    sep = SEPARATION_MS // BIN_MS
+    masked[max(0, best - sep):best + sep + 1] = 0
+    if votes[best] < MIN_MARGIN * masked.max(): return None
+
+    center = best * BIN_MS - MAX_OFFSET_MS + BIN_MS // 2
+    residuals = nearest_residuals(ref, pt + center)
+    matched = np.abs(residuals) <= MATCH_MS
+    if matched.mean() < MIN_MATCHED: return None
+    shift = center + int(np.median(residuals[matched]))
+    if abs(shift) >= MAX_OFFSET_MS: return None
+    return shift
+
+
+def shift_srt(text, matches, times, shift):
+    """Reescreve as linhas de tempo deslocadas de shift ms (sem tempos negativos)."""
+    shifted = np.maximum(times + shift, 0)
+    out, last = [], 0
+    for m, (start, end) in zip(matches, shifted):
+        out += [text[last:m.start()], format_srt_time(start), m.group(5), format_srt_time(end)]
+        last = m.end()
+    out.append(text[last:])
+    return "".join(out)
+
+
+def load_start_times(path):
+    """Inícios (ms) das falas de uma SRT no disco; encoding irrelevante, só os tempos importam."""
+    with open(path, 'rb') as f:
+        _, times = srt_timings(f.read().decode('utf-8', errors='replace'))
+    return times[:, 0]
+
+
+def fast_offset_sync(path_ref, path_pt, out_path):
+    """
+    Grava em out_path (UTF-8, como o ffsubsync) a PT-BR deslocada pelo offset estimado.
+    Retorna o offset em ms, ou None quando o caso não é um offset simples.
+    """
+    ref_starts = load_start_times(path_ref)
+    with open(path_pt, 'rb') as f:
+        raw_pt = f.read()
+    try:
+        # Mesmo contrato do ffsubsync --encoding utf-8: o que não for UTF-8 fica com ele
+        text_pt = raw_pt.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return None
+    matches, pt_times = srt_timings(text_pt)
+    if len(ref_starts) == 0 or len(pt_times) == 0: return None
+
+    shift = estimate_offset(ref_starts, pt_times[:, 0])
+    if shift is None: return None
+    with open(out_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(shift_srt(text_pt, matches, pt_times, shift))
+    return shift
@@ -0,0 +1,43 @@
+"""
+Worker do pool de processos do ffsubsync (ver FFS_POOL em addon.py).
+Sem efeitos colaterais no import: o ffsubsync (numpy/scipy/webrtcvad) só é
+carregado pelo init(), uma vez por processo, e fica pronto para os próximos syncs.
+"""
+import os
+import signal
+
+make_parser = run = None
+
+
+class SyncTimeout(Exception):
+    """O sync passou do limite contado a partir do início da execução no worker."""
+
+
+def _on_alarm(signum, frame):
+    raise SyncTimeout("ffsubsync passou do tempo limite")
+
+
+def init():
+    """Initializer do pool: importa o ffsubsync uma vez só."""
+    global make_parser, run
+    # Um thread de BLAS por processo: várias versões rodam em paralelo sem disputar os mesmos cores
+    for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[var] = "1"
+    from ffsubsync.ffsubsync import make_parser, run
+    if hasattr(signal, "SIGALRM"):
+        signal.signal(signal.SIGALRM, _on_alarm)
+
+
+def sync(path_ref, path_pt, out_path, timeout=None):
+    """
+    Roda o ffsubsync. Retorna (retval, offset_seconds, framerate_scale_factor).
+    timeout (s) conta só a execução: o tempo na fila do pool não entra.
+    """
+    args = make_parser().parse_args([path_ref, "-i", path_pt, "-o", out_path, "--encoding", "utf-8"])
+    use_alarm = timeout and hasattr(signal, "SIGALRM")
+    if use_alarm: signal.alarm(timeout)
+    try:
+        result = run(args)
+    finally:
+        if use_alarm: signal.alarm(0)
+    return result.get("retval", 1), result.get("offset_seconds"), result.get("framerate_scale_factor")
@@ -0,0 +1,125 @@
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+import fastsync
+
+
+def irregular_starts(rng, n=300, lo_gap=1200, hi_gap=5000):
+    t, starts = 1000, []
+    for _ in range(n):
+        t += rng.randint(lo_gap, hi_gap)
+        starts.append(t)
+    return starts
+
+
+def write_srt(path, starts, duration=1000, encoding="utf-8", newline="\n", text="fala {}"):
+    blocks = []
+    for i, s in enumerate(starts):
+        timing = f"{fastsync.format_srt_time(s)} --> {fastsync.format_srt_time(s + duration)}"
+        blocks.append(newline.join([str(i + 1), timing, text.format(i), ""]))
+    with open(path, "w", encoding=encoding, newline="") as f:
+        f.write(newline.join(blocks))
+
+
+def test_format_srt_time():
+    assert fastsync.format_srt_time(0) == "00:00:00,000"
+    assert fastsync.format_srt_time(3723004) == "01:02:03,004"
+
+
+def test_srt_timings_parses_start_and_end():
+    _, times = fastsync.srt_timings("1\n00:01:02,500 --> 00:01:04,000\nOi\n")
+    assert times.tolist() == [[62500, 64000]]
+
+
+@pytest.mark.parametrize("true_offset", [0, 80, -350, 2300, -4000, 6000, 9000])
+def test_estimate_offset_recovers_constant_offset(true_offset):
+    rng = random.Random(true_offset)
+    ref = irregular_starts(rng)
+    # PT-BR: 80% das falas da referência, deslocadas e com ruído de segmentação
+    pt = [s - true_offset + rng.randint(-60, 60) for s in ref if rng.random() < 0.8]
+    shift = fastsync.estimate_offset(ref, pt)
+    assert shift is not None
+    assert abs(shift - true_offset) <= 60
+
+
+def test_estimate_offset_never_aliases_on_irregular_gaps():
+    # Alias = publicar um offset errado; desistir (None) é sempre aceitável
+    for seed in range(400):
+        rng = random.Random(seed)
+        ref = irregular_starts(rng, n=200)
+        pt = [s + 4000 + rng.randint(-40, 40) for s in ref if rng.random() < 0.85]
+        shift = fastsync.estimate_offset(ref, pt)
+        assert shift is None or abs(shift + 4000) <= 50, (seed, shift)
+
+
+def test_estimate_offset_evenly_spaced_cues_do_not_alias_to_zero():
+    rng = random.Random(7)
+    ref = [3000 * i + rng.randint(-400, 400) for i in range(1, 400)]
+    pt = [s + 6000 for s in ref]
+    shift = fastsync.estimate_offset(ref, pt)
+    assert shift is None or shift == -6000
+
+
+def test_estimate_offset_gives_up_on_periodic_cues():
+    ref = [3000 * i for i in range(1, 200)]
+    pt = [s + 6000 for s in ref]
+    assert fastsync.estimate_offset(ref, pt) is None
+
+
+def test_estimate_offset_gives_up_on_framerate_drift():
+    rng = random.Random(3)
+    ref = irregular_starts(rng)
+    pt = [int(s * 25 / 23.976) for s in ref]
+    assert fastsync.estimate_offset(ref, pt) is None
+
+
+def test_estimate_offset_needs_enough_cues():
+    ref = [1000 * i for i in range(1, fastsync.MIN_CUES)]
+    assert fastsync.estimate_offset(ref, ref) is None
+
+
+def test_fast_offset_sync_writes_shifted_utf8(tmp_path):
+    rng = random.Random(11)
+    ref = irregular_starts(rng)
+    pt = [s + 1500 for s in ref]
+    write_srt(tmp_path / "ref.srt", ref)
+    # BOM + CRLF na entrada: a saída sai em UTF-8 sem BOM, como a do ffsubsync
+    write_srt(tmp_path / "pt.srt", pt, encoding="utf-8-sig", newline="\r\n", text="ação {}")
+
+    shift = fastsync.fast_offset_sync(tmp_path / "ref.srt", tmp_path / "pt.srt", tmp_path / "out.srt")
+    assert shift == -1500
+
+    raw = (tmp_path / "out.srt").read_bytes()
+    assert not raw.startswith(b"\xef\xbb\xbf")
+    text = raw.decode("utf-8")
+    assert "ação 0" in text
+    _, times = fastsync.srt_timings(text)
+    assert times[:, 0].tolist() == ref
+
+
+def test_fast_offset_sync_clamps_negative_times(tmp_path):
+    rng = random.Random(5)
+    ref = irregular_starts(rng)
+    pt = [s + 1500 for s in ref]
+    pt[0] = 200
+    write_srt(tmp_path / "ref.srt", ref)
+    write_srt(tmp_path / "pt.srt", pt)
+    assert fastsync.fast_offset_sync(tmp_path / "ref.srt", tmp_path / "pt.srt", tmp_path / "out.srt") == -1500
+    _, times = fastsync.srt_timings((tmp_path / "out.srt").read_text(encoding="utf-8"))
+    assert times[0].tolist() == [0, 0]
+
+
+def test_fast_offset_sync_leaves_non_utf8_to_ffsubsync(tmp_path):
+    rng = random.Random(9)
+    ref = irregular_starts(rng)
+    write_srt(tmp_path / "ref.srt", ref)
+    write_srt(tmp_path / "pt.srt", ref, encoding="latin-1", text="ação {}")
+    assert fastsync.fast_offset_sync(tmp_path / "ref.srt", tmp_path / "pt.srt", tmp_path / "out.srt") is None
+    assert not (tmp_path / "out.srt").exists()
+
+
+def test_load_start_times_ignores_encoding(tmp_path):
+    write_srt(tmp_path / "ref.srt", [1000, 5000], encoding="latin-1", text="ação {}")
+    assert fastsync.load_start_times(tmp_path / "ref.srt").tolist() == [1000, 5000]
@@ -0,0 +1,5 @@
+# Ponto de entrada WSGI para produção:
+#   gunicorn -b 0.0.0.0:$PORT -w 2 -k gthread --threads 8 wsgi:app
+from addon import app
+
+__all__ = ["app"]